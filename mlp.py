@@ -8,113 +8,117 @@ import tempfile
 import multiprocessing
 import itertools as it
 import numpy as np
+from scipy.special import expit
+from threadpoolctl import threadpool_limits
 
 
 def to_pgm (img, expect):
     digit = np.argmax(expect)
-    pixels = iter(img)
+    pixels = 255 - (np.asarray(img) * 255).astype(np.uint8).reshape(28, 28)
 
     with tempfile.NamedTemporaryFile('w', prefix = '{0}_'.format(digit), suffix = '.pgm', dir = '.', delete = False) as file:
-        print('P2', file = file)
-        print('28 28', file = file)
-        print('255', file = file)
-
-        for _ in range(28):
-            for _ in range(28):
-                print('{0}'.format(255 - int(next(pixels) * 255)), end = ' ', file = file)
-            print(file = file)
+        print('P2\n28 28\n255', file = file)
+        np.savetxt(file, pixels, fmt = '%d')
 
         return file.name
 
 def read_csv (fname):
-    data = []
-    digits = np.asmatrix(np.eye(10))
-
-    with open(fname, 'r') as file:
-        for line in file:
-            img = map(int, line.split(','))
-            expect = np.zeros(10)
-            digit = next(img)
+    data = np.loadtxt(fname, np.uint8, delimiter = ',', ndmin = 2)
 
-            data.append((
-                np.asmatrix(np.fromiter(img, np.float) / 255.0).T,
-                digits[ : , digit]
-            ))
+    inp = data[ : , 1 : ].astype(np.float32)
+    inp /= 255.0
 
-    return data
+    expect = np.eye(10, dtype = np.float32)[data[ : , 0 ]]
 
-def sigm (x):
-    with np.errstate(over = 'ignore'):
-        return 1.0 / (1.0 + np.exp(-x))
+    inp.flags.writeable = False
+    expect.flags.writeable = False
 
-def dsigm (x):
-    return np.multiply(x, (1.0 - x))
+    return inp, expect
 
-def dcost (expect, predict):
-    return predict - expect
+def layer_buffers (weights, rows):
+    return [ np.empty(( rows, w.shape[1] ), w.dtype) for w, _ in weights ]
 
-def execute (inp, weights):
+def execute (inp, weights, buffers):
     result = []
 
-    for w in weights:
-        inp = sigm(np.dot(np.append(1.0, inp), w).T)
+    for ( w, b ), buffer in zip(weights, buffers):
+        inp = np.matmul(inp, w, out = buffer[ : len(inp) ])
+        inp += b
+        expit(inp, out = inp)
         result.append(inp)
 
     return result
 
-def gradients (expect, out, weights):
-    result = [ 0.0 ] * len(weights)
+def evaluate (data, weights, chunk, eps = 1e-12):
+    inp, expect = data
+    wrong = 0
+    cost = 0.0
+    buffers = layer_buffers(weights, min(chunk, len(inp)))
 
-    result[-1] = dcost(expect, out[-1])
+    for start in range(0, len(inp), chunk):
+        part = expect[start : start + chunk]
+        predict = execute(inp[start : start + chunk], weights, buffers)[-1]
 
-    for i in range(len(weights) - 1):
-        i = len(weights) - i - 2
-        result[i] = weights[i + 1][ 1 : ] * result[i + 1]
+        wrong += np.count_nonzero(np.argmax(part, 1) != np.argmax(predict, 1))
 
-    return result
+        predict /= np.maximum(predict.sum(1, keepdims = True), eps)
 
-def delta (inp, grad, out):
-    result = []
-
-    for g, o in zip(grad, out):
-        result.append(np.outer(np.append(1.0, inp), g))
-        inp = o
-
-    return result
+        cost -= (
+            part * np.log(predict + eps) +
+            (1.0 - part) * np.log(1.0 - predict + eps)
+        ).sum()
 
-def cost (data, weights):
-    accum = 0
+    return wrong / len(inp), cost / len(inp)
 
-    for inp, expect in data:
-        predict = execute(inp, weights)[-1]
+def train_epoch (data, weights, velocity, accum, ratio, momentum, batch, chunk):
+    inp, expect = data
+    step = len(inp) if batch == np.inf else batch
+    chunk = min(step, chunk, len(inp))
+    perm = np.random.permutation(len(inp))
 
-        psum = predict.sum()
+    inp_buffer = np.empty(( chunk, inp.shape[1] ), inp.dtype)
+    expect_buffer = np.empty(( chunk, expect.shape[1] ), expect.dtype)
+    buffers = layer_buffers(weights, chunk)
+    errors = layer_buffers(weights, chunk)
 
-        if psum > 0:
-            predict = predict / psum
+    for start in range(0, len(inp), step):
+        idx = perm[start : start + step]
 
-        zero = np.asarray(expect == 0.0).reshape(-1)
-        one = ~zero
+        for sub in range(0, len(idx), chunk):
+            part = np.sort(idx[sub : sub + chunk])
+            batch_inp = np.take(inp, part, 0, out = inp_buffer[ : len(part) ])
+            batch_expect = np.take(expect, part, 0, out = expect_buffer[ : len(part) ])
 
-        with np.errstate(divide = 'ignore', over = 'ignore'):
-            predict[zero] = np.nan_to_num(np.log(1 - predict[zero]))
-            predict[one] = np.multiply(expect[one], np.log(predict[one]))
+            out = execute(batch_inp, weights, buffers)
+            grad = np.subtract(out[-1], batch_expect, out = out[-1])
+            grad *= ratio / len(idx)
 
-            accum -= predict.sum()
+            for i in reversed(range(len(weights))):
+                below = out[i - 1] if i else batch_inp
+                gw, gb = accum[i]
 
-    return accum / len(data)
+                if sub:
+                    gw += below.T @ grad
+                    gb += grad.sum(0)
+                else:
+                    np.matmul(below.T, grad, out = gw)
+                    np.sum(grad, 0, out = gb)
 
-def error (data, weights):
-    count = 0
+                if i:
+                    grad = np.matmul(grad, weights[i][0].T, out = errors[i - 1][ : len(part) ])
+                    grad *= below
+                    grad *= np.subtract(1.0, below, out = below)
 
-    for inp, expect in data:
-        if np.argmax(expect) != np.argmax(execute(inp, weights)[-1]):
-            count += 1
-
-    return count / len(data)
+        for w, v, a in zip(*map(it.chain.from_iterable, ( weights, velocity, accum ))):
+            np.multiply(v, momentum, out = v)
+            np.subtract(v, a, out = v)
+            np.add(w, v, out = w)
 
 mlp_globals = {}
 
+def init_worker (threads):
+    mlp_globals['limits'] = threadpool_limits(threads)
+
 def mlp (data):
     ( ratio, batch, hidden ), pos, size = data
 
@@ -127,8 +131,13 @@ def mlp (data):
         batch = int(batch)
 
     generations = args.generations if args.generations == np.inf else int(args.generations)
+    momentum = args.momentum
+    chunk = args.chunk
+    stop = args.stop
+    dump = args.dump
+    validating = bool(args.validate)
 
-    if args.dump:
+    if dump:
         with lock:
             print('( ratio = {}, batch = {}, hidden = {}, pos = {} / {} ): STARTING'.format(
                 ratio, batch, hidden, pos + 1, size
@@ -139,7 +148,7 @@ def mlp (data):
 
     nodes = ( 784, hidden, 10 )
 
-    old = weights = None
+    velocity = weights = None
     gen = 0
 
     if args.load:
@@ -153,27 +162,36 @@ def mlp (data):
                 size = int(next(file))
 
                 weights = [ None ] * size
-                old = [ None ] * size
+                velocity = [ None ] * size
 
                 for i in range(size):
                     rows, cols = map(int, next(file).strip().split())
                     dtype = next(file).strip()
 
-                    weights[i] = np.asmatrix(
-                        np.fromiter(map(float, next(file).strip().split()), dtype)
+                    w = np.fromiter(
+                        map(float, next(file).strip().split()), dtype
                     ).reshape(rows, cols)
 
-
-                    old[i] = np.asmatrix(
-                        np.fromiter(map(float, next(file).strip().split()), dtype)
+                    v = np.fromiter(
+                        map(float, next(file).strip().split()), dtype
                     ).reshape(rows, cols)
 
+                    weights[i] = ( w[ 1 : ], w[0] )
+                    velocity[i] = ( v[ 1 : ], v[0] )
+
     if weights is None:
-        old = weights = [
-            np.asmatrix(np.random.randn(nf + 1, nt))
+        weights = [
+            (
+                np.random.randn(nf, nt).astype(np.float32),
+                np.random.randn(nt).astype(np.float32)
+            )
                 for nf, nt in zip(nodes[ : -1 ], nodes[ 1 : ])
         ]
 
+        velocity = [ ( np.zeros_like(w), np.zeros_like(b) ) for w, b in weights ]
+
+    accum = [ ( np.empty_like(w), np.empty_like(b) ) for w, b in weights ]
+
     start_time = time.time()
 
     try:
@@ -181,29 +199,22 @@ def mlp (data):
 
             gen += 1
 
-            train_error = error(train, weights)
-            validate_error = (
-                error(validate, weights)
-                    if args.validate else
-                train_error
+            train_error, train_cost = evaluate(train, weights, chunk)
+            validate_error, validate_cost = (
+                evaluate(validate, weights, chunk)
+                    if validating else
+                ( train_error, train_cost )
             )
 
-            if args.validate:
+            if validating:
                 validate_errors.append(validate_error)
 
             train_errors.append(train_error)
 
-            train_cost = np.linalg.norm(cost(train, weights))
-            validate_cost = (
-                np.linalg.norm(cost(validate, weights))
-                    if args.validate else
-                train_cost
-            )
-
-            if train_error <= args.stop:
+            if train_error <= stop:
                 break
 
-            if args.dump:
+            if dump:
                 with lock:
                     print('( ratio = {}, batch = {}, hidden = {}, pos = {} / {} ): ITERATION\n  '
                           'gen {} / {} verr = {:.5f} terr = {:.5f} '
@@ -213,31 +224,9 @@ def mlp (data):
                         validate_cost, train_cost
                     ), flush = True)
 
-            batch_size = 0
-            accum = [ np.zeros(w.shape, w.dtype) for w in weights ]
-
-            np.random.shuffle(train)
-
-            for j, (inp, expect) in enumerate(train):
-                out = execute(inp, weights)
-                grads = gradients(expect, out, weights)
-
-                accum = np.add(accum, delta(inp, grads, out))
-
-                batch_size += 1
-
-                if batch_size == batch or (j + 1) == len(train):
-
-                    new_weights = np.add(weights, np.subtract(
-                        np.multiply(args.momentum, old),
-                        np.multiply(ratio, np.divide(accum, batch_size))
-                    ))
-
-                    old = weights
-                    weights = new_weights
-
-                    batch_size = 0
-                    accum = [ np.zeros(w.shape, w.dtype) for w in weights ]
+            train_epoch(
+                train, weights, velocity, accum, ratio, momentum, batch, chunk
+            )
 
     except KeyboardInterrupt:
         pass
@@ -252,7 +241,7 @@ def mlp (data):
         with open(fname, 'w') as file:
             print(' '.join(map(str, train_errors)), file = file)
 
-            if args.validate:
+            if validating:
                 print(' '.join(map(str, validate_errors)), file = file)
 
         if args.save:
@@ -264,13 +253,13 @@ def mlp (data):
                 print(gen, file = file)
                 print(len(weights), file = file)
 
-                for w, o in zip(weights, old):
-                    print('{} {}'.format(w.shape[0], w.shape[1]), file = file)
+                for ( w, b ), ( vw, vb ) in zip(weights, velocity):
+                    print('{} {}'.format(w.shape[0] + 1, w.shape[1]), file = file)
                     print('{}'.format(w.dtype.char), file = file)
-                    print(' '.join(map(str, np.ravel(w))), file = file)
-                    print(' '.join(map(str, np.ravel(o))), file = file)
+                    print(' '.join(map(str, it.chain(b, np.ravel(w)))), file = file)
+                    print(' '.join(map(str, it.chain(vb, np.ravel(vw)))), file = file)
 
-    if args.dump:
+    if dump:
         with lock:
             print('( ratio = {}, batch = {}, hidden = {}, pos = {} / {} ): ENDING\n  '
                   'time = {:.5f}s generations = {}'.format(
@@ -286,6 +275,7 @@ argparser.add_argument('-momentum', type = float, default = 0.0001)
 argparser.add_argument('-ratio', type = float, default = [ 0.5 ], nargs = '*')
 argparser.add_argument('-batch', type = float, default = [ 10.0 ], nargs = '*')
 argparser.add_argument('-hidden', type = int, default = [ 100 ], nargs = '*')
+argparser.add_argument('-chunk', type = int, default = 512)
 argparser.add_argument('-generations', type = float, default = np.inf)
 argparser.add_argument('-stop', type = float, default = -np.inf)
 argparser.add_argument('-validate', type = str, default = False)
@@ -298,17 +288,19 @@ args = argparser.parse_args()
 
 print('reading files', flush = True)
 train = validate = read_csv(args.input)
-print('{0} train instances'.format(len(train)), flush = True)
+print('{0} train instances'.format(len(train[0])), flush = True)
 
 if args.validate:
     validate = read_csv(args.validate)
-    print('{0} validation instances'.format(len(validate)), flush = True)
+    print('{0} validation instances'.format(len(validate[0])), flush = True)
+
+context = multiprocessing.get_context('fork')
 
 mlp_globals = {
     'args': args,
     'train': train,
     'validate': validate,
-    'lock': multiprocessing.Lock()
+    'lock': context.Lock()
 }
 
 unique = set()
@@ -317,7 +309,8 @@ experiments = [
         if not (e in unique or unique.add(e))
 ]
 
-pool = multiprocessing.Pool(min(args.threads, len(experiments)))
+workers = min(args.threads, len(experiments))
+pool = context.Pool(workers, init_worker, ( max(1, args.threads // workers), ))
 asyn = pool.map_async(mlp, (
     ( e, pos, len(experiments) )
         for pos, e in enumerate(experiments)